@@ -1,6 +1,15 @@
 import websockify.autobind
 
 import asyncio
+import socket
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on every platform
+    uvloop = None
+
+# high-water mark of the transport write buffer
+WRITE_BUFFER_HIGH = 256 * 1024
 
 
 class EchoServer(asyncio.Protocol):
@@ -8,6 +17,10 @@ class EchoServer(asyncio.Protocol):
         peername = transport.get_extra_info('peername')
         print('connection from {}'.format(peername))
         self.transport = transport
+        self.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        # the greeting is tiny, don't let nagle hold it back
+        sock = transport.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         #data = open('/srv/www/html/terms/miedit-master/dump','rb').read()
         data = b"3613 PYTHON37"
         self.transport.write(data  )
@@ -19,6 +32,9 @@ class EchoServer(asyncio.Protocol):
         # close the socket
         self.transport.close()
 
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 loop = asyncio.get_event_loop()
 coro = loop.create_server(EchoServer, '127.0.0.1', 20080)
 server = loop.run_until_complete(coro)
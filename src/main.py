@@ -2,17 +2,28 @@
 application without writing javascript
 
 """
+import asyncio
+import itertools
 import logging
+import os
 import re
+import signal
+import sys
 from collections import namedtuple
+from functools import lru_cache
 from functools import wraps
-from json import dumps
-from json import loads
-from uuid import uuid4
+from types import MappingProxyType
 
 #import daiquiri
 import aiohttp
 from aiohttp import web
+from orjson import dumps
+from orjson import loads
+
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on every platform
+    uvloop = None
 
 
 #daiquiri.setup(level=logging.DEBUG)
@@ -24,11 +35,20 @@ class BeyondException(Exception):
     pass
 
 
-def generate_unique_key(dictionary):
-    key = uuid4().hex
-    if key not in dictionary:
-        return key
-    raise BeyondException('Seems like the dictionary is full')
+# Keys only need to be unique within a page, counters are good enough
+_event_counter = itertools.count()
+_input_counter = itertools.count()
+
+
+def generate_unique_key():
+    """Return a key that was never returned before"""
+    return str(next(_event_counter))
+
+
+# Most nodes have no attributes or no children, they share those
+# read-only values until they are updated.
+EMPTY_ATTRIBUTES = MappingProxyType(dict())
+EMPTY_CHILDREN = tuple()
 
 
 class Node(object):  # inspired from nevow
@@ -45,12 +65,16 @@ class Node(object):  # inspired from nevow
 
     def __init__(self, tag):
         self._tag = tag
-        self._children = list()
-        self._attributes = dict()
+        self._children = EMPTY_CHILDREN
+        self._attributes = EMPTY_ATTRIBUTES
 
     def __call__(self, **kwargs):
         """Update node's attributes"""
-        self._attributes.update(kwargs)
+        if self._attributes:
+            self._attributes.update(kwargs)
+        elif kwargs:
+            # `kwargs` is a new dictionary, no need to copy it
+            self._attributes = kwargs
         return self
 
     def __repr__(self):
@@ -58,73 +82,122 @@ class Node(object):  # inspired from nevow
 
     def append(self, node):
         """Append a single node or string as a child"""
-        self._children.append(node)
+        if self._children:
+            self._children.append(node)
+        else:
+            self._children = [node]
 
     def extend(self, nodes):
-        [self.append(node) for node in nodes]
+        """Append several nodes or strings as children"""
+        if self._children:
+            self._children.extend(nodes)
+        else:
+            self._children = list(nodes)
 
     def __getitem__(self, nodes):
         """Add nodes as children"""
         # XXX: __getitem__ is implemented in terms of `Node.append`
-        # so that widgets can simply inherit from node and override
-        # self.append with the bound `Node.append`.
+        # and `Node.extend` so that widgets can simply inherit from node
+        # and override them with the bound `Node.append` and `Node.extend`.
         if isinstance(nodes, (str, float, int)):
             self.append(nodes)
         elif isinstance(nodes, (list, tuple)):
-            [self.append(node) for node in nodes]
+            self.extend(nodes)
         else:
             self.append(nodes)
         return self
 
 
+class Serialized(object):
+    """Wrap the dict representation of a `Node` hierarchy that doesn't
+    reference callbacks so that it can be cached and inserted as is in
+    another `Node` hierarchy.
+
+    """
+
+    __slots__ = ('_dict',)
+
+    def __init__(self, node):
+        # the dictionaries are never released, they are cached
+        self._dict, events, _ = serialize(node)
+        if events:
+            raise BeyondException('Serialized nodes must not have events')
+
+    def __repr__(self):
+        return '<Serialized: %s>' % self._dict
+
+
+# Python attribute names of html attributes that are python keywords
+ATTRIBUTES = {'Class': 'class', 'For': 'for'}
+
+
+# Freelist of the cleared dictionaries released by `serialize`, they
+# spare the allocator and the garbage collector on every render.
+DICTIONARIES = list()
+DICTIONARIES_MAX = 4096
+
+
 def serialize(node):
     """Convert a `Node` hierarchy to a json string.
 
-    Returns two values:
+    Returns three values:
 
     - the dict representation
     - an event dictionary mapping event keys to callbacks
+    - a function to call once the dict representation is not used
+      anymore, it returns its dictionaries to the freelist
 
     """
 
     events = dict()
-
-    def to_html_attributes(attributes):
-        """Filter and convert attributes to html attributes"""
-        for key, value in attributes.items():
-            if key.startswith('on_'):
-                pass
-            elif key == 'Class':
-                yield 'class', value
-            elif key == 'For':
-                yield 'for', value
+    rename = ATTRIBUTES.get
+    pool = DICTIONARIES
+    allocated = list()
+    root = [None]
+    # The tree is walked with an explicit stack of (node, siblings, index)
+    # where `siblings` is the children list of the parent dictionary
+    # and `index` the position `node` must be stored at.
+    stack = [(node, root, 0)]
+    while stack:
+        node, siblings, index = stack.pop()
+        if isinstance(node, (str, float, int)):
+            siblings[index] = node
+            continue
+        if isinstance(node, Serialized):
+            siblings[index] = node._dict
+            continue
+        out = pool.pop() if pool else dict()
+        attributes = pool.pop() if pool else dict()
+        allocated.append(out)
+        allocated.append(attributes)
+        out['tag'] = node._tag
+        out['attributes'] = attributes
+        # Filter and convert attributes to html attributes and events
+        on = None
+        for key, value in node._attributes.items():
+            if key[:3] == 'on_':
+                if on is None:
+                    on = pool.pop() if pool else dict()
+                    allocated.append(on)
+                    out['on'] = on
+                event = generate_unique_key()
+                events[event] = value
+                on[key[3:]] = event
             else:
-                yield key, value
+                attributes[rename(key, key)] = value
+        children = [None] * len(node._children)
+        out['children'] = children
+        siblings[index] = out
+        for index, child in enumerate(node._children):
+            stack.append((child, children, index))
 
-    def to_html_events(attributes):
-        """Filter and rename attributes referencing callbacks"""
-        for key, value in attributes.items():
-            if key.startswith('on_'):
-                yield key[3:], value
-
-    def to_dict(node):
-        """Recursively convert `node` into a dictionary"""
-        if isinstance(node, (str, float, int)):
-            return node
-        else:
-            out = dict(tag=node._tag)
-            out['attributes'] = dict(to_html_attributes(node._attributes))
-            on = dict()
-            for event, callback in to_html_events(node._attributes):
-                key = generate_unique_key(events)
-                events[key] = callback  # XXX: side effect!
-                on[event] = key
-            if on:
-                out['on'] = on
-            out['children'] = [to_dict(child) for child in node._children]
-            return out
+    def release():
+        for dictionary in allocated:
+            dictionary.clear()
+        pool.extend(allocated[:DICTIONARIES_MAX - len(pool)])
+        allocated.clear()
 
-    return to_dict(node), events
+    return root[0], events, release
 
 
 class PythonHTML(object):
@@ -141,9 +214,8 @@ class PythonHTML(object):
 
     def form(self, **kwargs):
         """form element that prevents default 'submit' behavior"""
-        node = Node('form')
-        node._attributes['onsubmit'] = 'return false;'
-        node._attributes.update(**kwargs)
+        node = Node('form')(onsubmit='return false;')
+        node(**kwargs)
         return node
 
     def input(self, **kwargs):
@@ -155,10 +227,10 @@ class PythonHTML(object):
                 pass
             else:
                 log.warning("id attribute on text input node ignored")
-            node = Node('input#' + uuid4().hex)
+            node = Node('input#' + format(next(_input_counter), 'x'))
         else:
             node = Node('input')
-        node._attributes.update(**kwargs)
+        node(**kwargs)
         return node
 
     def __getattr__(self, attribute_name):
@@ -172,28 +244,29 @@ def beyond(callable):
     """There is something beyond javascript ;)"""
 
     @wraps(callable)
-    async def wrapper(*args):
+    async def wrapper(event):
         # execute event handler
-        await callable(*args)
+        await callable(event)
         # re-render the page
-        event = args[-1]
         html = await event.request.app.render(event)
         # serialize the html and extract event handlers
-        html, events = serialize(html)
+        html, events, release = serialize(html)
         # update events handlers
         event.websocket.events = events
         # send html update
         msg = dict(
             html=html,
         )
-        await event.websocket.send_str(dumps(msg))
+        msg = dumps(msg)
+        release()
+        await event.websocket.queue.put(msg)
 
     return wrapper
 
 
 class Event:
 
-    __slot__ = ('type', 'request', 'websocket', 'path', 'payload')
+    __slots__ = ('type', 'request', 'websocket', 'path', 'payload')
 
     def __init__(self, type, request, websocket, path, payload):
         self.type = type
@@ -203,11 +276,81 @@ class Event:
         self.payload = payload
 
 
+# maximum number of messages waiting to be sent on a websocket
+QUEUE_SIZE = 256
+# maximum number of messages coalesced into a single websocket frame
+BATCH_SIZE = 128
+
+
+async def writer(websocket):
+    """Send the messages queued on `websocket`.
+
+    Messages are utf-8 encoded json. Those that are ready at the same
+    time are sent as a single text frame holding a json array.
+
+    """
+    queue = websocket.queue
+    while True:
+        msgs = [await queue.get()]
+        while not queue.empty() and len(msgs) < BATCH_SIZE:
+            msgs.append(queue.get_nowait())
+        try:
+            # send_frame takes the bytes as is, send_str would want a str
+            data = b'[' + b','.join(msgs) + b']'
+            await websocket.send_frame(data, aiohttp.WSMsgType.TEXT)
+        except ConnectionError:
+            log.debug('websocket connection lost', exc_info=True)
+            # stop the reader, nothing drains the queue anymore
+            await websocket.close()
+            return
+
+
+# prefix of the init message as sent by main.js
+INIT_PREFIX = '{"type":"init","path":"'
+
+
+def init_path(data):
+    """Return the path of the init message `data` without parsing
+    the json, return None if `data` is another kind of message or if
+    the path has escaped characters"""
+    if data.startswith(INIT_PREFIX) and data.endswith('"}'):
+        path = data[len(INIT_PREFIX):-2]
+        if '"' not in path and '\\' not in path:
+            return path
+    return None
+
+
 async def websocket(request):
     """websocket handler"""
-    websocket = web.WebSocketResponse()
+    # messages are small and distinct, compression is not worth the cpu
+    websocket = web.WebSocketResponse(compress=False)
     await websocket.prepare(request)
+    websocket.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    reading = asyncio.ensure_future(reader(request, websocket))
+    writing = asyncio.ensure_future(writer(websocket))
+    try:
+        # the connection is over as soon as one of them stops, even if
+        # the reader is blocked on a full queue
+        await asyncio.wait((reading, writing), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        reading.cancel()
+        writing.cancel()
+        results = await asyncio.gather(reading, writing, return_exceptions=True)
+
+    print('websocket connection closed')
+
+    # cancellations are not errors, CancelledError is a BaseException
+    errors = [result for result in results if isinstance(result, Exception)]
+    for error in errors[1:]:
+        log.error('websocket task failed', exc_info=error)
+    if errors:
+        raise errors[0]
+
+    return websocket
+
 
+async def reader(request, websocket):
+    """Process the messages received on `websocket`"""
     async for msg in websocket:
 
         if msg.type == aiohttp.WSMsgType.ERROR:
@@ -217,7 +360,12 @@ async def websocket(request):
         elif msg.type == aiohttp.WSMsgType.CLOSE:
             break
         elif msg.type == aiohttp.WSMsgType.TEXT:
-            event = loads(msg.data)
+            path = init_path(msg.data)
+            if path is not None:
+                # the init handshake has a fixed layout, skip json parsing for it
+                event = dict(type='init', path=path)
+            else:
+                event = loads(msg.data)
             log.debug('websocket got message type: %s', event["type"])
             if event['type'] == 'init':
 
@@ -225,12 +373,14 @@ async def websocket(request):
                 event = Event('init', request, websocket, event['path'], None)
                 html = await request.app.render(event)
                 # serialize html and extract event handlers
-                html, events = serialize(html)
+                html, events, release = serialize(html)
                 # update event handlers
                 websocket.events = events
                 # send html update
                 msg = dict(html=html)
-                await websocket.send_str(dumps(msg))
+                msg = dumps(msg)
+                release()
+                await websocket.queue.put(msg)
             elif event['type'] == 'dom-event':
                 # Build backend event
                 key = event['key']
@@ -242,28 +392,25 @@ async def websocket(request):
                 # render page
                 html = await request.app.render(event)
                 # serialize html and extract event handlers
-                html, events = serialize(html)
+                html, events, release = serialize(html)
                 # update event handlers
                 websocket.events = events
                 # send html update
                 msg = dict(html=html)
-                await websocket.send_str(dumps(msg))
+                msg = dumps(msg)
+                release()
+                await websocket.queue.put(msg)
             else:
                 msg = "msg type '%s' is not supported yet" % msg['type']
                 raise NotImplementedError(msg)
         else:
             raise NotImplementedError(msg)
 
-    print('websocket connection closed')
-
-    return websocket
-
 
 async def index(request):
     """Return the index page"""
-    with open('index.html', 'rb') as f:
-        INDEX = f.read()
-    return web.Response(body=INDEX, content_type='text/html')
+    # FileResponse relies on sendfile(2) when the loop supports it
+    return web.FileResponse('index.html')
 
 
 app = web.Application()
@@ -273,40 +420,131 @@ app.router.add_static('/static', path='static')
 app.router.add_route('GET', '/{path:.+}', index)
 
 
-Route = namedtuple('Route', ('regex', 'init', 'render'))
+# `start` and `stop` slice the route's arguments out of `match.groups()`
+Route = namedtuple('Route', ('init', 'render', 'start', 'stop'))
+
+
+# characters that give a special meaning to a regex
+METACHARACTERS = '.^$*+?{}[]\\|()'
+
+
+def literal(pattern):
+    """Return the path matched by `pattern` if it is a plain string
+    anchored at both ends, otherwise return None"""
+    if pattern.startswith('^') and pattern.endswith('$'):
+        path = pattern[1:-1]
+        if not any(char in path for char in METACHARACTERS):
+            return path
+    return None
+
+
+NOT_FOUND = Serialized(h.h1()['No route found'])
+
+
+# Constructs that depend on the group numbers or names of a pattern, or
+# on flags that apply to the whole regex: named groups and backreferences,
+# numbered backreferences (conservatively, any backslash followed by a
+# digit), conditionals and inline flags.
+UNCOMBINABLE = re.compile(r'\\[0-9]|\(\?(P[<=]|\(|[aiLmsux])')
+
+
+class Alternation:
+    """Regex routes compiled into a single regex where each pattern is
+    wrapped in a group, so that a path is dispatched with one `match`
+    whatever the number of routes"""
+
+    def __init__(self):
+        self._patterns = list()
+        # map the index of the group wrapping a pattern to its route
+        self._routes = dict()
+        self._groups = 0
+        self._match = None
+
+    def add(self, pattern, groups, init, render):
+        index = self._groups + 1
+        self._routes[index] = Route(init, render, index, index + groups)
+        self._groups = index + groups
+        self._patterns.append('(' + pattern + ')')
+        self._match = re.compile('|'.join(self._patterns)).match
+
+    def __call__(self, path):
+        """Return the route matching `path` and its arguments or None"""
+        match = self._match(path)
+        if match is None:
+            return None
+        # The group wrapping the matched pattern is the last closed
+        route = self._routes[match.lastindex]
+        return route, match.groups()[route.start:route.stop]
+
+
+class Pattern:
+    """Regex route that is matched on its own"""
+
+    def __init__(self, regex, init, render):
+        self._match = regex.match
+        self._route = Route(init, render, 0, regex.groups)
+
+    def __call__(self, path):
+        """Return the route matching `path` and its arguments or None"""
+        match = self._match(path)
+        if match is None:
+            return None
+        return self._route, match.groups()
 
 
 class Router:
-    """Why yet another router..."""
+    """Why yet another router...
+
+    Literal routes are looked up in a dictionary. Consecutive regex
+    routes are combined into an `Alternation` unless the pattern uses
+    one of the `UNCOMBINABLE` constructs, in which case it is matched on
+    its own. Either way routes are tried in the order they were added.
+
+    """
 
     def __init__(self):
-        self._routes = list()
+        self._literals = dict()
+        self._matchers = list()
+
+    def _lookup(self, path):
+        for matcher in self._matchers:
+            found = matcher(path)
+            if found is not None:
+                return found
+        return None
 
     def add_route(self, pattern, init, render):
         regex = re.compile(pattern)
-        route = Route(regex, init, render)
-        self._routes.append(route)
+        path = literal(pattern)
+        # A literal route is looked up before the regex routes, that is
+        # only correct if none of the previous routes match it.
+        if path is not None and self._lookup(path) is None:
+            self._literals.setdefault(path, Route(init, render, 0, 0))
+        elif UNCOMBINABLE.search(pattern) is not None:
+            self._matchers.append(Pattern(regex, init, render))
+        else:
+            if not self._matchers or not isinstance(self._matchers[-1], Alternation):
+                self._matchers.append(Alternation())
+            self._matchers[-1].add(pattern, regex.groups, init, render)
 
     async def __call__(self, event):
         path = event.path
         print('rendering path: %s' % path)
-        for route in self._routes:
-            match = route.regex.match(path)
-            if match is not None:
-                # This is a match
-                args = match.groups()
-                if event.type == 'init':
-                    # call init function for the route
-                    await route.init(*args, event)
-                # render the route
-                html = route.render(*args, event)
-                return html
-            else:
-                # keep looking
-                continue
+        route = self._literals.get(path)
+        if route is not None:
+            args = ()
         else:
-            # Ark! The route is not defined!
-            return h.h1()['No route found']
+            found = self._lookup(path)
+            if found is None:
+                # Ark! The route is not defined!
+                return NOT_FOUND
+            route, args = found
+        if event.type == 'init':
+            # call init function for the route
+            await route.init(*args, event)
+        # render the route
+        html = route.render(*args, event)
+        return html
 
 
 # XXX: Here begins custom code #########################################
@@ -332,20 +570,37 @@ async def on_submit(event):
         event.request.model['conversation'].append(message)
 
 
+@lru_cache(maxsize=1024)
+def render_message(command, replies):
+    """Render a message of the conversation where `replies` is a tuple
+    of (chat, reply) pairs.
+
+    Messages do not change once they are in the conversation, so the
+    result is cached as `Serialized` nodes.
+
+    """
+    nodes = [h.p()[command]]
+    append = nodes.append
+    for chat, reply in replies:
+        # afficher les replies les moins cheres et proposer les autres
+        # avec un code couleur sur le prix
+        append(h.p(Class=f'reply {chat}')[f'{chat}: {reply}'])
+    return tuple(Serialized(node) for node in nodes)
+
+
+HEADER = Serialized(h.h1()["beyondjs"])
+
+
 def render_chatbot(model):
     log.debug('render chatbot: %r', model)
     shell = h.div(id="shell", Class="chatbot")
 
-    shell.append(h.h1()["beyondjs"])
+    shell.append(HEADER)
 
     for messages in model['conversation']:
         command = messages['command']
-        replies = messages['replies']
-        shell.append(h.p()[command])
-        for chat, reply in replies.items():
-            # afficher les replies les moins cheres et proposer les autres
-            # avec un code couleur sur le prix
-            shell.append(h.p(Class='reply ' + chat)[chat + ': ' + reply])
+        replies = tuple(messages['replies'].items())
+        shell.extend(render_message(command, replies))
 
     chatbox = h.div(id="chatbox")
     form = h.form(on_submit=on_submit)
@@ -398,6 +653,55 @@ router.add_route(r'^/$', index_init, index_render)
 
 
 # start the app at localhost:8080
-web.run_app(app)
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+# Rendering is cpu bound, on linux the server can run several processes
+# that share the port with SO_REUSEPORT and let the kernel balance the
+# connections between them. The state of a page lives with its websocket
+# connection so the processes share nothing.
+WORKERS = int(os.environ.get('BEYONDJS_WORKERS', 1))
+
+
+def supervise(workers):
+    """Fork `workers` processes serving `app` on the same port, forward
+    SIGINT and SIGTERM to them and exit once they are all gone"""
+    pids = list()
+
+    def forward(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    # install the handlers before forking so that no signal is lost
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # worker process
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # ctrl-c must only reach the supervisor, that forwards it
+            os.setpgid(0, 0)
+            web.run_app(app, reuse_port=True)
+            sys.exit()
+        pids.append(pid)
+
+    failed = False
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        failed = failed or os.waitstatus_to_exitcode(status) != 0
+    sys.exit(1 if failed else 0)
+
+
+if WORKERS > 1 and sys.platform.startswith('linux'):
+    supervise(WORKERS)
+else:
+    if WORKERS > 1:
+        log.warning('SO_REUSEPORT balancing is only supported on linux')
+    web.run_app(app)
 
 # <3
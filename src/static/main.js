@@ -52,14 +52,18 @@ var translate = function(json) {
 
 ws.onmessage = function(msg) {
     console.log('onmessage', msg);
-    var msg = JSON.parse(msg.data);
-    container = patch(container, translate(msg.html))
+    // the backend batches messages in a json array
+    var msgs = JSON.parse(msg.data);
+    for (var index = 0; index < msgs.length; index++) {
+        container = patch(container, translate(msgs[index].html));
+    }
 }
 
 ws.onopen = function (_) {
+    // keep `type` first, the backend recognize init messages by prefix
     var msg = {
-        path: location.pathname,
         type: 'init',
+        path: location.pathname,
     };
     ws.send(JSON.stringify(msg));
 };